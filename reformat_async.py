@@ -0,0 +1,251 @@
+"""
+asyncio interface to the reformatter, for services that run on an event loop.
+
+The rules run in an executor (the loop's default thread pool unless one is
+given; pass a ProcessPoolExecutor to keep CPU-bound rule work off the GIL) and
+files are read and written on worker threads, so the loop never blocks.
+"""
+
+import asyncio
+from collections.abc import AsyncIterator, Iterable
+from concurrent.futures import Executor
+from dataclasses import dataclass
+from functools import partial
+from pathlib import Path
+
+import reformat_file
+from reformat_file import (
+    PipelineOptions,
+    RuleTimeoutError,
+    RunReport,
+    ShadowResult,
+    SkippedFileError,
+)
+
+
+@dataclass
+class FileResult:
+    file_path: Path
+    changed: bool
+    # Name of the rule that was running when the file ran over its time budget
+    timed_out_rule: str | None = None
+    # Why the file was not read, if it was binary, undecodable or oversized
+    skipped_reason: str | None = None
+    # Comparison with the reference rules, if the file was in the shadow sample
+    shadow: ShadowResult | None = None
+    # Skipped because the journal of an earlier run shows it done
+    resumed: bool = False
+
+
+async def reformat_text(
+    file_name: str,
+    file_data: str,
+    full_mode: bool = False,
+    time_budget: float | None = None,
+    executor: Executor | None = None,
+) -> str:
+    """
+    >>> asyncio.run(reformat_text("test.java", "new Long(1)"))
+    'Long.valueOf(1)'
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        executor,
+        partial(
+            reformat_file.reformat_text, file_name, file_data, full_mode, time_budget
+        ),
+    )
+
+
+# Reformat every file below root, yielding each result as soon as it is done.
+#
+# At most `concurrency` files are in flight at once, and with max_memory only
+# as many as fit the memory budget. Closing the iterator, or
+# cancelling the task consuming it, cancels the files still in flight; a file
+# is only ever replaced by its complete reformatted contents.
+async def iter_reformat_tree(
+    root: Path,
+    options: PipelineOptions | None = None,
+    executor: Executor | None = None,
+    concurrency: int = 8,
+) -> AsyncIterator[FileResult]:
+    options = options or PipelineOptions()
+    files = await asyncio.to_thread(
+        reformat_file.select_files, Path(root), options, RunReport()
+    )
+    async for result in _iter_reformat_files(files, options, executor, concurrency):
+        yield result
+
+
+async def reformat_tree(
+    root: Path,
+    options: PipelineOptions | None = None,
+    executor: Executor | None = None,
+    concurrency: int = 8,
+) -> RunReport:
+    options = options or PipelineOptions()
+    report = RunReport()
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+
+    files = await asyncio.to_thread(
+        reformat_file.select_files, Path(root), options, report
+    )
+    async for result in _iter_reformat_files(files, options, executor, concurrency):
+        if result.timed_out_rule is not None:
+            report.timed_out.append(
+                {"file": str(result.file_path), "rule": result.timed_out_rule}
+            )
+            continue
+        if result.skipped_reason is not None:
+            report.skipped_files.append(
+                {"file": str(result.file_path), "reason": result.skipped_reason}
+            )
+            continue
+        if result.resumed:
+            report.files_resumed += 1
+            continue
+        report.files_processed += 1
+        if result.shadow is not None:
+            report.add_shadow(result.file_path, result.shadow)
+        if result.changed:
+            report.files_changed += 1
+            report.changed_files.append(str(result.file_path))
+
+    report.elapsed_seconds = loop.time() - started
+    return report
+
+
+async def _iter_reformat_files(
+    files: Iterable[Path],
+    options: PipelineOptions,
+    executor: Executor | None,
+    concurrency: int,
+) -> AsyncIterator[FileResult]:
+    # Nothing would ever be admitted, so the files would silently go unread
+    if concurrency < 1:
+        raise ValueError(f"concurrency must be at least 1, not {concurrency}")
+    remaining = iter(files)
+    next_path = next(remaining, None)
+    footprint: int | None = None
+    in_flight: set[asyncio.Task[FileResult]] = set()
+    budget = reformat_file._MemoryBudget(options.max_memory)
+    footprints: dict[asyncio.Task[FileResult], int] = {}
+    # Writes and journal records outlive a cancelled task, see _run_to_completion
+    unfinished: set[asyncio.Future[None]] = set()
+    journal = None
+    if options.journal is not None:
+        journal = await asyncio.to_thread(
+            reformat_file.Journal, options.journal, options.resume
+        )
+    try:
+        while True:
+            while next_path is not None and len(in_flight) < concurrency:
+                # Sized once, however many passes it waits to be admitted
+                if footprint is None:
+                    footprint = 0
+                    if options.max_memory is not None:
+                        footprint = await asyncio.to_thread(budget.footprint, next_path)
+                # Always admitted when nothing is in flight
+                if not budget.try_acquire(footprint):
+                    break
+                task = asyncio.create_task(
+                    _reformat_one(next_path, options, executor, journal, unfinished)
+                )
+                in_flight.add(task)
+                footprints[task] = footprint
+                next_path, footprint = next(remaining, None), None
+            if not in_flight:
+                return
+
+            done, in_flight = await asyncio.wait(
+                in_flight, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                budget.release(footprints.pop(task))
+                yield task.result()
+    finally:
+        for task in in_flight:
+            task.cancel()
+        if in_flight:
+            await asyncio.gather(*in_flight, return_exceptions=True)
+        if unfinished:
+            await asyncio.gather(*unfinished, return_exceptions=True)
+        if journal is not None:
+            await asyncio.to_thread(journal.close)
+
+
+async def _reformat_one(
+    file_path: Path,
+    options: PipelineOptions,
+    executor: Executor | None,
+    journal: reformat_file.Journal | None,
+    unfinished: set[asyncio.Future[None]],
+) -> FileResult:
+    try:
+        prefetched_file = await asyncio.to_thread(
+            reformat_file._prefetch_file, file_path, options, journal
+        )
+    except SkippedFileError as skipped:
+        return FileResult(file_path, changed=False, skipped_reason=skipped.reason)
+    if prefetched_file is None:
+        return FileResult(file_path, changed=False, resumed=True)
+    file_data, encoding, input_hash = prefetched_file
+    shadow = None
+    try:
+        if reformat_file._in_shadow_sample(file_path, options.shadow_rate):
+            loop = asyncio.get_running_loop()
+            new_data, shadow = await loop.run_in_executor(
+                executor,
+                partial(
+                    reformat_file.shadow_reformat_text,
+                    file_path.name,
+                    file_data,
+                    options.full_mode,
+                    options.time_budget,
+                    options.shadow_reference_cap,
+                ),
+            )
+        else:
+            new_data = await reformat_text(
+                file_path.name,
+                file_data,
+                options.full_mode,
+                options.time_budget,
+                executor,
+            )
+    except RuleTimeoutError as timeout:
+        if options.quarantine is not None:
+            await asyncio.to_thread(
+                reformat_file._add_to_quarantine, options.quarantine, file_path
+            )
+        return FileResult(file_path, changed=False, timed_out_rule=timeout.rule_name)
+
+    if new_data == file_data:
+        if journal is not None:
+            await _run_to_completion(
+                unfinished, journal.record, file_path, input_hash, input_hash
+            )
+        return FileResult(file_path, changed=False, shadow=shadow)
+    await _run_to_completion(
+        unfinished,
+        reformat_file._write_back,
+        file_path,
+        new_data,
+        encoding,
+        input_hash,
+        journal,
+    )
+    return FileResult(file_path, changed=True, shadow=shadow)
+
+
+# Run func on a worker thread that cancelling the caller cannot abandon.
+#
+# A cancelled to_thread call leaves its thread running, so a write could still
+# be recording in the journal after the iterator closed it. The call is shielded
+# instead and tracked in `unfinished` until done, for the iterator to wait on.
+async def _run_to_completion(unfinished: set[asyncio.Future[None]], func, *args):
+    future = asyncio.ensure_future(asyncio.to_thread(func, *args))
+    unfinished.add(future)
+    future.add_done_callback(unfinished.discard)
+    await asyncio.shield(future)
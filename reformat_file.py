@@ -1,9 +1,30 @@
-import sys
+import argparse
+import codecs
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter, defaultdict, deque
+from contextlib import nullcontext
+from contextvars import ContextVar
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Executor,
+    Future,
+    ThreadPoolExecutor,
+    wait,
+)
+from dataclasses import asdict, dataclass, field
 from pathlib import Path
-from collections.abc import Callable
+from collections.abc import Callable, Iterator
 from typing import List, Self
 import re
 
+import reference_rules
+
 
 class HtmlElement:
     def __init__(self, full: str) -> None:
@@ -67,64 +88,1192 @@ class HtmlElement:
 
 
 # Run the reformatter on the given file
-def main():
-    if len(sys.argv) > 1:
-        file_path = Path(sys.argv[1])
-        full_mode = False
-        if len(sys.argv) > 2:
-            full_mode = sys.argv[2] == "-f" or sys.argv[2] == "--full"
-        print(f"Reformatting file {file_path}.")
+def main(argv: list[str] | None = None):
+    parser = _argument_parser()
+    args = parser.parse_args(argv)
+    if args.merge_reports:
+        report = RunReport.merge(read_report(path) for path in args.merge_reports)
+        if args.report is None:
+            print(json.dumps(asdict(report), indent=2))
+        else:
+            write_report(report, args.report)
+        return
+    if args.file_path is None:
+        parser.error("missing argument 'file_path'")
+    if args.resume and args.journal is None:
+        parser.error("--resume needs the --journal of the run to resume")
+
+    file_path = Path(args.file_path)
+    if args.audit:
         try:
-            reformat_file(file_path, full_mode)
-            print("Done.")
+            counts = audit_tree(file_path, args.audit_depth, args.read_workers)
         except FileNotFoundError:
             print(f"fatal: File {file_path} not found.")
-    else:
-        print("Usage: python reformat_file.py file_path [-f | --full].")
-        print("fatal: Missing argument 'file_path'.")
+            return
+        if args.audit_format == "json":
+            print(json.dumps(audit_json(counts), indent=2))
+        else:
+            print(audit_table(counts))
+        return
+
+    print(f"Reformatting file {file_path}.")
+    try:
+        options = PipelineOptions(
+            full_mode=args.full,
+            read_workers=args.read_workers,
+            write_workers=args.write_workers,
+            prefetch_depth=args.prefetch_depth,
+            writeback_depth=args.writeback_depth,
+            shard=args.shard,
+            balance_shards=args.balance_by_size,
+            time_budget=args.time_budget,
+            quarantine=args.quarantine,
+            fallback_encoding=args.fallback_encoding,
+            max_file_size=args.max_file_size,
+            shadow_rate=args.shadow_rate,
+            journal=args.journal,
+            resume=args.resume,
+            max_memory=args.max_memory,
+            trace_memory=args.trace_memory,
+        )
+        report = reformat_tree(file_path, options)
+        print(
+            f"Changed {report.files_changed} of {report.files_processed} files "
+            f"in {report.elapsed_seconds:.2f}s."
+        )
+        if report.files_resumed:
+            print(f"Skipped {report.files_resumed} files already in the journal.")
+        if report.file_peak_memory:
+            largest = sorted(report.file_peak_memory.items(), key=lambda item: -item[1])
+            for traced_file, peak in largest[:5]:
+                print(f"memory: {traced_file} peaked at {peak} bytes.")
+            for rule, peak in report.rule_peak_memory.items():
+                print(f"memory: {rule} peaked at {peak} bytes.")
+        for timeout in report.timed_out:
+            print(
+                f"warning: {timeout['file']} ran over the {args.time_budget}s "
+                f"budget in {timeout['rule']} and was skipped."
+            )
+        for skipped in report.skipped_files:
+            print(f"warning: skipped {skipped['file']}: {skipped['reason']}.")
+        if report.shadow_files:
+            print(f"Shadowed {report.shadow_files} files with the reference rules.")
+            for rule, speedup in report.shadow_speedups().items():
+                print(f"shadow: {rule} ran {speedup:.1f}x the reference speed.")
+            for timeout in report.shadow_reference_timeouts:
+                print(
+                    f"warning: the reference {timeout['rule']} ran over its cap "
+                    f"on {timeout['file']} and was not compared."
+                )
+            for mismatch in report.shadow_mismatches:
+                print(
+                    f"warning: {mismatch['rule']} differs from the reference on "
+                    f"{mismatch['file']}; reproducer: {mismatch['reproducer']!r}"
+                )
+        if args.report is not None:
+            write_report(report, args.report)
+        print("Done.")
+    except FileNotFoundError:
+        print(f"fatal: File {file_path} not found.")
+
+
+def _argument_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="reformat_file.py",
+        description="Reformat common problems in legacy JSF codebases.",
+    )
+    parser.add_argument("file_path", nargs="?", help="file or directory to reformat")
+    parser.add_argument(
+        "-f", "--full", action="store_true", help="also apply the ui-g to p-grid rules"
+    )
+    parser.add_argument(
+        "--read-workers",
+        type=_positive_int,
+        default=PipelineOptions.read_workers,
+        help="threads reading files ahead of the rules",
+    )
+    parser.add_argument(
+        "--write-workers",
+        type=_positive_int,
+        default=PipelineOptions.write_workers,
+        help="threads writing changed files back",
+    )
+    parser.add_argument(
+        "--prefetch-depth",
+        type=_positive_int,
+        default=PipelineOptions.prefetch_depth,
+        help="maximum number of files read but not yet reformatted",
+    )
+    parser.add_argument(
+        "--writeback-depth",
+        type=_positive_int,
+        default=PipelineOptions.writeback_depth,
+        help="maximum number of reformatted files waiting to be written",
+    )
+    parser.add_argument(
+        "--shard",
+        type=_shard_spec,
+        metavar="i/N",
+        help="only process the i-th of N stable, non-overlapping shards (1-based)",
+    )
+    parser.add_argument(
+        "--balance-by-size",
+        action="store_true",
+        help="balance shards by total file size instead of file count",
+    )
+    parser.add_argument(
+        "--time-budget",
+        type=float,
+        metavar="SECONDS",
+        help="skip any file whose rules take longer than this",
+    )
+    parser.add_argument(
+        "--quarantine",
+        type=Path,
+        metavar="LIST",
+        help="record files that run over the time budget here and skip them later",
+    )
+    parser.add_argument(
+        "--fallback-encoding",
+        type=_codec_name,
+        metavar="ENCODING",
+        help="decode files that are not UTF-8 with this encoding, e.g. latin-1, "
+        "and write them back in it; without it such files are skipped",
+    )
+    parser.add_argument(
+        "--max-file-size",
+        type=_positive_int,
+        default=PipelineOptions.max_file_size,
+        metavar="BYTES",
+        help="skip files larger than this",
+    )
+    parser.add_argument(
+        "--shadow-rate",
+        type=_fraction,
+        default=0.0,
+        metavar="P",
+        help="also run the reference rules on this fraction of files and report "
+        "any output that differs",
+    )
+    parser.add_argument(
+        "--journal",
+        type=Path,
+        metavar="PATH",
+        help="record each completed file here so an interrupted run can resume",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="skip files the journal shows were already completed and unchanged since",
+    )
+    parser.add_argument(
+        "--max-memory",
+        type=_positive_int,
+        metavar="BYTES",
+        help="admit files only while their estimated memory fits this budget; "
+        "files larger than the budget are processed alone",
+    )
+    parser.add_argument(
+        "--trace-memory",
+        action="store_true",
+        help="measure the peak memory of each file and rule (slow)",
+    )
+    parser.add_argument(
+        "--audit",
+        action="store_true",
+        help="count the remaining deprecated usages instead of reformatting",
+    )
+    parser.add_argument(
+        "--audit-format",
+        choices=("table", "json"),
+        default="table",
+        help="how to print the audit counts",
+    )
+    parser.add_argument(
+        "--audit-depth",
+        type=_positive_int,
+        default=1,
+        metavar="N",
+        help="group audit counts by the first N directories below file_path",
+    )
+    parser.add_argument(
+        "--report", type=Path, help="write the run report to this JSON file"
+    )
+    parser.add_argument(
+        "--merge-reports",
+        nargs="+",
+        type=Path,
+        metavar="REPORT",
+        help="combine per-shard JSON reports into one instead of reformatting",
+    )
+    return parser
+
+
+def _positive_int(value: str) -> int:
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"expected a positive integer, got {value}")
+    return number
+
+
+def _fraction(value: str) -> float:
+    number = float(value)
+    if not 0 <= number <= 1:
+        raise argparse.ArgumentTypeError(f"expected a number from 0 to 1, got {value}")
+    return number
+
+
+def _codec_name(value: str) -> str:
+    try:
+        codecs.lookup(value)
+    except LookupError:
+        raise argparse.ArgumentTypeError(f"unknown encoding {value}")
+    return value
+
+
+def _shard_spec(value: str) -> tuple[int, int]:
+    index, _, count = value.partition("/")
+    try:
+        shard = int(index), int(count)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected i/N, got {value}")
+    if not 1 <= shard[0] <= shard[1]:
+        raise argparse.ArgumentTypeError(f"expected 1 <= i <= N, got {value}")
+    return shard
+
+
+# Default size above which files are skipped without being read
+_MAX_FILE_SIZE = 16 * 1024 * 1024
 
 
 # Reformat the given file according to my rules
-def reformat_file(file_path: Path, full_mode: bool = False):
+def reformat_file(
+    file_path: Path,
+    full_mode: bool = False,
+    fallback_encoding: str | None = None,
+    max_file_size: int | None = _MAX_FILE_SIZE,
+):
+    if fallback_encoding is not None:
+        codecs.lookup(fallback_encoding)
     file_to_reformat: Path = Path(file_path)
     if file_to_reformat.is_dir():
-        for nested_file in file_to_reformat.iterdir():
-            reformat_file(nested_file)
+        reformat_tree(
+            file_to_reformat,
+            PipelineOptions(
+                full_mode=full_mode,
+                fallback_encoding=fallback_encoding,
+                max_file_size=max_file_size,
+            ),
+        )
     elif file_to_reformat.is_file():
-
-        file_data = ""
-
-        with file_path.open(encoding="UTF-8") as old_file:
-            file_data = old_file.read()
-            if file_path.name.endswith(".xhtml"):
-                if full_mode:
-                    file_data = ui_g_to_p_grid(file_data)
-                file_data = shorthand_close_xhtml_elements(file_data)
-            elif file_path.name.endswith(".java"):
-                file_data = resolve_object_util_deprecation(file_data)
-                file_data = resolve_raw_tabchange(file_data)
-                file_data = resolve_raw_events(file_data)
-                file_data = resolve_primitive_constructors(file_data)
-                file_data = resolve_bigdecimal_constants(file_data)
-
-        file_to_rem = Path(file_path)
-        file_to_rem.unlink()
-
-        with file_path.open(mode="x", encoding="UTF-8") as old_file:
-            old_file.write(file_data)
+        if not file_rules(file_to_reformat.name, full_mode):
+            return
+        file_data, encoding = _read_file(
+            file_to_reformat, fallback_encoding, max_file_size
+        )
+        new_data = reformat_text(file_to_reformat.name, file_data, full_mode)
+        if new_data != file_data:
+            _write_file(file_to_reformat, new_data, encoding)
     elif not file_to_reformat.exists():
         raise FileNotFoundError()
 
 
+class SkippedFileError(Exception):
+    def __init__(self, file_path: Path, reason: str) -> None:
+        super().__init__(f"{file_path}: {reason}")
+        self.file_path = file_path
+        self.reason = reason
+
+    def __reduce__(self):
+        return type(self), (self.file_path, self.reason)
+
+
+class RuleTimeoutError(Exception):
+    def __init__(self, file_name: str, rule_name: str, time_budget: float) -> None:
+        super().__init__(
+            f"{file_name} ran over the {time_budget}s budget in {rule_name}"
+        )
+        self.file_name = file_name
+        self.rule_name = rule_name
+        self.time_budget = time_budget
+
+    # Keep the details when raised in a worker process
+    def __reduce__(self):
+        return type(self), (self.file_name, self.rule_name, self.time_budget)
+
+
+class _TimeBudgetExceeded(Exception):
+    pass
+
+
+# perf_counter() deadline for the file being reformatted on this thread, if any
+_file_deadline: ContextVar[float | None] = ContextVar("_file_deadline", default=None)
+
+
+# Called from the rule loops so a pathological file is abandoned promptly
+def _check_time_budget():
+    deadline = _file_deadline.get()
+    if deadline is not None and time.perf_counter() > deadline:
+        raise _TimeBudgetExceeded()
+
+
+# Apply every rule for the given file name to its contents
+def reformat_text(
+    file_name: str,
+    file_data: str,
+    full_mode: bool = False,
+    time_budget: float | None = None,
+    shadow: "ShadowResult | None" = None,
+    memory: "MemoryPeaks | None" = None,
+) -> str:
+    """
+    >>> reformat_text("test.xhtml", '<div class="ui-g"></div>', full_mode=True)
+    '<div class="p-grid" />'
+    >>> reformat_text("notes.txt", "new Long(1)")
+    'new Long(1)'
+    """
+    file_memory = 0 if memory is None else tracemalloc.get_traced_memory()[0]
+    rules = file_rules(file_name, full_mode)
+    imports = None
+    if file_name.endswith(".java"):
+        # The Java rules only see the body; imports are edited through JavaImports
+        imports, file_data = JavaImports.split(file_data)
+
+    deadline = None if time_budget is None else time.perf_counter() + time_budget
+    deadline_token = _file_deadline.set(deadline)
+    try:
+        for rule in rules:
+            try:
+                rule_input = file_data
+                if memory is not None:
+                    tracemalloc.reset_peak()
+                    rule_memory = tracemalloc.get_traced_memory()[0]
+                started = time.perf_counter()
+                file_data = _run_rule(rule, file_data, imports)
+                _check_time_budget()
+                if memory is not None:
+                    memory.record(rule.__name__, rule_memory, file_memory)
+                if shadow is not None:
+                    shadow.compare(
+                        rule, rule_input, file_data, time.perf_counter() - started
+                    )
+            except _TimeBudgetExceeded:
+                raise RuleTimeoutError(file_name, rule.__name__, time_budget) from None
+    finally:
+        _file_deadline.reset(deadline_token)
+
+    if imports is not None:
+        file_data = imports.header() + file_data
+    return file_data
+
+
+def _run_rule(
+    rule: Callable[..., str], file_data: str, imports: "JavaImports | None"
+) -> str:
+    if rule in IMPORT_AWARE_RULES:
+        return rule(file_data, imports)
+    return rule(file_data)
+
+
+# What shadow mode found on one file: the time each rule and its reference
+# implementation took on the same input, and the rules whose outputs differed.
+#
+# The reference rules run outside the file's time budget, since they are not
+# what the file is reformatted with. Instead each comparison, including the
+# shrinking of a mismatch, is capped at reference_cap seconds; a reference rule
+# that runs over it is recorded and its rule is left uncompared.
+@dataclass
+class ShadowResult:
+    reference_cap: float = 5.0
+    # rule name -> [seconds in the rule, seconds in the reference rule]
+    rule_seconds: dict[str, list[float]] = field(default_factory=dict)
+    # {"rule": ..., "reproducer": ..., "expected": ..., "actual": ...}
+    mismatches: list[dict[str, str]] = field(default_factory=list)
+    # Rules whose reference implementation ran over reference_cap
+    reference_timeouts: list[str] = field(default_factory=list)
+
+    def compare(
+        self,
+        rule: Callable[..., str],
+        rule_input: str,
+        rule_output: str,
+        rule_seconds: float,
+    ):
+        deadline_token = _file_deadline.set(None)
+        reference_token = reference_rules.reference_deadline.set(
+            time.perf_counter() + self.reference_cap
+        )
+        try:
+            self._compare(rule, rule_input, rule_output, rule_seconds)
+        except reference_rules.ReferenceTimeout:
+            self.reference_timeouts.append(rule.__name__)
+        finally:
+            reference_rules.reference_deadline.reset(reference_token)
+            _file_deadline.reset(deadline_token)
+
+    def _compare(
+        self,
+        rule: Callable[..., str],
+        rule_input: str,
+        rule_output: str,
+        rule_seconds: float,
+    ):
+        reference_rule = getattr(reference_rules, rule.__name__)
+        started = time.perf_counter()
+        reference_output = _rule_outcome(reference_rule, rule_input)
+        reference_seconds = time.perf_counter() - started
+
+        timings = self.rule_seconds.setdefault(rule.__name__, [0.0, 0.0])
+        timings[0] += rule_seconds
+        timings[1] += reference_seconds
+        if reference_output == rule_output:
+            return
+
+        def fast_rule(file_data: str) -> str:
+            return _rule_outcome(
+                lambda file_data: _run_rule(rule, file_data, JavaImports()), file_data
+            )
+
+        try:
+            reproducer = _minimize_mismatch(
+                rule_input,
+                lambda text: fast_rule(text) != _rule_outcome(reference_rule, text),
+            )
+            expected = _rule_outcome(reference_rule, reproducer)
+        except reference_rules.ReferenceTimeout:
+            # Out of time to shrink it; the whole rule input still reproduces it
+            reproducer, expected = rule_input, reference_output
+        self.mismatches.append(
+            {
+                "rule": rule.__name__,
+                "reproducer": reproducer,
+                "expected": expected,
+                "actual": fast_rule(reproducer),
+            }
+        )
+
+
+def shadow_reformat_text(
+    file_name: str,
+    file_data: str,
+    full_mode: bool = False,
+    time_budget: float | None = None,
+    reference_cap: float = ShadowResult.reference_cap,
+) -> tuple[str, ShadowResult]:
+    shadow = ShadowResult(reference_cap)
+    new_data = reformat_text(file_name, file_data, full_mode, time_budget, shadow)
+    return new_data, shadow
+
+
+# A rule's output, or a description of the exception it raised
+def _rule_outcome(rule: Callable[[str], str], file_data: str) -> str:
+    try:
+        return rule(file_data)
+    except reference_rules.ReferenceTimeout:
+        raise
+    except Exception as error:
+        return f"{type(error).__name__}: {error}"
+
+
+# Drop chunks of lines, halving the chunk size each pass, for as long as the
+# input still shows the mismatch. Stops after max_attempts rule runs.
+def _minimize_mismatch(
+    file_data: str, still_differs: Callable[[str], bool], max_attempts: int = 500
+) -> str:
+    r"""
+    >>> _minimize_mismatch("a\nb\nbad\nc\n", lambda text: "bad" in text)
+    'bad\n'
+    """
+    lines = file_data.splitlines(keepends=True)
+    chunk_size = max(len(lines) // 2, 1)
+    attempts = 0
+    while attempts < max_attempts:
+        start = 0
+        while start < len(lines) and attempts < max_attempts:
+            candidate = lines[:start] + lines[start + chunk_size :]
+            attempts += 1
+            if candidate and still_differs("".join(candidate)):
+                lines = candidate
+            else:
+                start += chunk_size
+        if chunk_size == 1:
+            break
+        chunk_size //= 2
+    return "".join(lines)
+
+
+# Peak memory traced by tracemalloc while one file's rules ran, in bytes above
+# what was allocated when the file or the rule started. tracemalloc sees every
+# thread, so reads and writes overlapping the rules are counted too.
+@dataclass
+class MemoryPeaks:
+    file_peak: int = 0
+    rule_peaks: dict[str, int] = field(default_factory=dict)
+
+    def record(self, rule_name: str, rule_memory: int, file_memory: int):
+        peak = tracemalloc.get_traced_memory()[1]
+        self.rule_peaks[rule_name] = max(
+            self.rule_peaks.get(rule_name, 0), peak - rule_memory
+        )
+        self.file_peak = max(self.file_peak, peak - file_memory)
+
+
+def _in_shadow_sample(file_path: Path, shadow_rate: float) -> bool:
+    if shadow_rate <= 0:
+        return False
+    file_hash = hashlib.sha1(str(file_path).encode("UTF-8")).digest()[:8]
+    return int.from_bytes(file_hash) < shadow_rate * 2**64
+
+
+def file_rules(file_name: str, full_mode: bool = False) -> list[Callable[[str], str]]:
+    if file_name.endswith(".xhtml"):
+        rules = [ui_g_to_p_grid] if full_mode else []
+        return rules + [shorthand_close_xhtml_elements]
+    elif file_name.endswith(".java"):
+        return [
+            resolve_object_util_deprecation,
+            resolve_raw_tabchange,
+            resolve_raw_events,
+            resolve_primitive_constructors,
+            resolve_bigdecimal_constants,
+        ]
+    return []
+
+
+# Bytes sniffed for a byte order mark or NUL bytes before reading the rest
+_SNIFF_SIZE = 8192
+
+# Byte order marks, and the encodings that strip them on read and restore them
+# on write. Python's "utf-16" codec writes the platform's byte order, so UTF-16
+# files are tracked by their own byte order and their mark written back as-is.
+_BYTE_ORDER_MARKS = [
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16-le+bom"),
+    (codecs.BOM_UTF16_BE, "utf-16-be+bom"),
+]
+_MARKED_ENCODINGS = {
+    "utf-16-le+bom": ("utf-16-le", codecs.BOM_UTF16_LE),
+    "utf-16-be+bom": ("utf-16-be", codecs.BOM_UTF16_BE),
+}
+
+
+# Read a file as text, returning its contents and the encoding to write it in.
+#
+# Oversized files are rejected from their size alone, and binary files from
+# their first few KB, so neither is read in full. Line endings are kept as-is.
+def _read_file(
+    file_path: Path,
+    fallback_encoding: str | None = None,
+    max_file_size: int | None = None,
+) -> tuple[str, str]:
+    raw_data, encoding = _read_file_bytes(file_path, max_file_size)
+    return _decode_file(file_path, raw_data, encoding, fallback_encoding)
+
+
+# The read stage of the pipelines: the file's text, the encoding to write it
+# in and the hash of its contents, or None if the journal shows it is done.
+def _prefetch_file(
+    file_path: Path, options: "PipelineOptions", journal: "Journal | None"
+) -> tuple[str, str, str] | None:
+    raw_data, encoding = _read_file_bytes(file_path, options.max_file_size)
+    input_hash = _content_hash(raw_data)
+    if options.resume and journal is not None:
+        if journal.is_complete(file_path, input_hash):
+            return None
+    file_data, encoding = _decode_file(
+        file_path, raw_data, encoding, options.fallback_encoding
+    )
+    return file_data, encoding, input_hash
+
+
+# A file's bytes and the encoding its byte order mark asks for, if any
+def _read_file_bytes(file_path: Path, max_file_size: int | None) -> tuple[bytes, str]:
+    with file_path.open(mode="rb") as old_file:
+        file_size = os.fstat(old_file.fileno()).st_size
+        if max_file_size is not None and file_size > max_file_size:
+            raise SkippedFileError(
+                file_path, f"larger than {max_file_size} bytes ({file_size})"
+            )
+        head = old_file.read(_SNIFF_SIZE)
+        encoding = "UTF-8"
+        for byte_order_mark, bom_encoding in _BYTE_ORDER_MARKS:
+            if head.startswith(byte_order_mark):
+                encoding = bom_encoding
+                break
+        else:
+            if b"\0" in head:
+                raise SkippedFileError(file_path, "looks binary")
+        return head + old_file.read(), encoding
+
+
+def _decode_file(
+    file_path: Path, raw_data: bytes, encoding: str, fallback_encoding: str | None
+) -> tuple[str, str]:
+    codec, byte_order_mark = _MARKED_ENCODINGS.get(encoding, (encoding, b""))
+    try:
+        return raw_data[len(byte_order_mark) :].decode(codec), encoding
+    except UnicodeDecodeError:
+        if fallback_encoding is None or encoding != "UTF-8":
+            raise SkippedFileError(file_path, f"not valid {codec}") from None
+    try:
+        return raw_data.decode(fallback_encoding), fallback_encoding
+    except UnicodeDecodeError:
+        raise SkippedFileError(
+            file_path, f"neither UTF-8 nor {fallback_encoding}"
+        ) from None
+
+
+def _write_file(file_path: Path, file_data: str, encoding: str = "UTF-8") -> bytes:
+    codec, byte_order_mark = _MARKED_ENCODINGS.get(encoding, (encoding, b""))
+    raw_data = byte_order_mark + file_data.encode(codec)
+    _replace_file(file_path, raw_data)
+    return raw_data
+
+
+# Write the new contents next to the file and rename them over it, so an
+# interrupted run leaves either the old file or the new one, never neither.
+def _replace_file(file_path: Path, raw_data: bytes):
+    file_mode = file_path.stat().st_mode
+    new_file = tempfile.NamedTemporaryFile(
+        dir=file_path.parent, prefix=f".{file_path.name}.", suffix=".tmp", delete=False
+    )
+    try:
+        with new_file:
+            new_file.write(raw_data)
+            new_file.flush()
+            os.fsync(new_file.fileno())
+        os.chmod(new_file.name, file_mode)
+        os.replace(new_file.name, file_path)
+    except BaseException:
+        Path(new_file.name).unlink(missing_ok=True)
+        raise
+
+
+# The writeback stage of the pipelines: replace the file, then journal it
+def _write_back(
+    file_path: Path,
+    file_data: str,
+    encoding: str,
+    input_hash: str,
+    journal: "Journal | None",
+):
+    raw_data = _write_file(file_path, file_data, encoding)
+    if journal is not None:
+        journal.record(file_path, input_hash, _content_hash(raw_data))
+
+
+def _content_hash(raw_data: bytes) -> str:
+    return hashlib.sha256(raw_data).hexdigest()
+
+
+# Append-only record of the files a run has completed, one JSON line each with
+# the hashes of the file before and after its rules ran. Lines are flushed as
+# they are written and fsynced every fsync_every entries and on close.
+#
+# A resumed run skips a file whose contents still hash to the output recorded
+# for it, which is its input hash if the rules didn't change it. A file edited
+# since is reformatted again.
+class Journal:
+    def __init__(
+        self, journal_path: Path, resume: bool = False, fsync_every: int = 100
+    ) -> None:
+        journal_path = Path(journal_path)
+        self._completed = self._load(journal_path) if resume else {}
+        self._file = journal_path.open(mode="a" if resume else "w", encoding="UTF-8")
+        self._fsync_every = fsync_every
+        self._unsynced = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _load(journal_path: Path) -> dict[str, str]:
+        completed = {}
+        if not journal_path.exists():
+            return completed
+        with journal_path.open(encoding="UTF-8") as journal_file:
+            for line in journal_file:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # The last line of a journal cut off mid-write
+                    continue
+                completed[entry["file"]] = entry["output_hash"]
+        return completed
+
+    def is_complete(self, file_path: Path, content_hash: str) -> bool:
+        return self._completed.get(str(Path(file_path).resolve())) == content_hash
+
+    def record(self, file_path: Path, input_hash: str, output_hash: str):
+        entry = {
+            "file": str(Path(file_path).resolve()),
+            "input_hash": input_hash,
+            "output_hash": output_hash,
+        }
+        with self._lock:
+            self._file.write(json.dumps(entry) + "\n")
+            self._file.flush()
+            self._unsynced += 1
+            if self._unsynced >= self._fsync_every:
+                os.fsync(self._file.fileno())
+                self._unsynced = 0
+
+    def close(self):
+        with self._lock:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+@dataclass
+class PipelineOptions:
+    full_mode: bool = False
+    # Threads blocked on open().read() while the rules run on earlier files
+    read_workers: int = 4
+    # Threads flushing changed files so the rules never wait on a write
+    write_workers: int = 2
+    # Files read ahead of the rules; bounds memory held by the read stage
+    prefetch_depth: int = 16
+    # Changed files waiting on a writer; bounds memory held by the write stage
+    writeback_depth: int = 16
+    # (i, N): only process the i-th of N shards of the tree, counting from 1
+    shard: tuple[int, int] | None = None
+    # Split shards by total file size rather than by path hash alone
+    balance_shards: bool = False
+    # Seconds a single file may spend in the rules before it is skipped
+    time_budget: float | None = None
+    # File listing paths that ran over the time budget; they are skipped later
+    quarantine: Path | None = None
+    # Encoding for files that are not UTF-8; without one they are skipped
+    fallback_encoding: str | None = None
+    # Files larger than this many bytes are skipped without being read
+    max_file_size: int | None = _MAX_FILE_SIZE
+    # Fraction of files also run through the reference rules and compared
+    shadow_rate: float = 0.0
+    # Seconds a reference rule may run on one file before it is left uncompared
+    shadow_reference_cap: float = 5.0
+    # Journal of completed files, and whether to skip the ones it lists
+    journal: Path | None = None
+    resume: bool = False
+    # Bytes of estimated file memory admitted at once; see _MemoryBudget
+    max_memory: int | None = None
+    # Measure each file's and rule's peak memory with tracemalloc. Only the
+    # threaded pipeline measures; it slows the rules down several times.
+    trace_memory: bool = False
+
+    def __post_init__(self):
+        # Fail before any file is read rather than at the first non-UTF-8 one
+        if self.fallback_encoding is not None:
+            codecs.lookup(self.fallback_encoding)
+
+
+@dataclass
+class RunReport:
+    files_processed: int = 0
+    files_changed: int = 0
+    elapsed_seconds: float = 0.0
+    changed_files: list[str] = field(default_factory=list)
+    # {"file": ..., "rule": ...} for each file abandoned over the time budget
+    timed_out: list[dict[str, str]] = field(default_factory=list)
+    quarantined_files: list[str] = field(default_factory=list)
+    # {"file": ..., "reason": ...} for each binary, undecodable or oversized file
+    skipped_files: list[dict[str, str]] = field(default_factory=list)
+    shadow_files: int = 0
+    # Files skipped because the journal of an earlier run shows them done
+    files_resumed: int = 0
+    # Peak traced memory in bytes per file, and the largest seen per rule
+    file_peak_memory: dict[str, int] = field(default_factory=dict)
+    rule_peak_memory: dict[str, int] = field(default_factory=dict)
+    # Shadow mode's per-rule [seconds, reference seconds] and mismatches
+    shadow_rule_seconds: dict[str, list[float]] = field(default_factory=dict)
+    shadow_mismatches: list[dict[str, str]] = field(default_factory=list)
+    # {"file": ..., "rule": ...} for each reference rule that ran over its cap
+    shadow_reference_timeouts: list[dict[str, str]] = field(default_factory=list)
+
+    # Combine the reports of shards that ran side by side
+    @classmethod
+    def merge(cls, reports) -> Self:
+        merged = cls()
+        for report in reports:
+            merged.files_processed += report.files_processed
+            merged.files_changed += report.files_changed
+            merged.elapsed_seconds = max(merged.elapsed_seconds, report.elapsed_seconds)
+            merged.changed_files.extend(report.changed_files)
+            merged.timed_out.extend(report.timed_out)
+            merged.quarantined_files.extend(report.quarantined_files)
+            merged.skipped_files.extend(report.skipped_files)
+            merged.shadow_files += report.shadow_files
+            merged.files_resumed += report.files_resumed
+            merged.file_peak_memory.update(report.file_peak_memory)
+            for rule, peak in report.rule_peak_memory.items():
+                merged.rule_peak_memory[rule] = max(
+                    merged.rule_peak_memory.get(rule, 0), peak
+                )
+            _add_rule_seconds(merged.shadow_rule_seconds, report.shadow_rule_seconds)
+            merged.shadow_mismatches.extend(report.shadow_mismatches)
+            merged.shadow_reference_timeouts.extend(report.shadow_reference_timeouts)
+        merged.changed_files.sort()
+        return merged
+
+    def add_shadow(self, file_path: Path, shadow: ShadowResult):
+        self.shadow_files += 1
+        _add_rule_seconds(self.shadow_rule_seconds, shadow.rule_seconds)
+        for mismatch in shadow.mismatches:
+            self.shadow_mismatches.append({"file": str(file_path), **mismatch})
+        for rule in shadow.reference_timeouts:
+            self.shadow_reference_timeouts.append(
+                {"file": str(file_path), "rule": rule}
+            )
+
+    def add_memory(self, file_path: Path, memory: MemoryPeaks):
+        self.file_peak_memory[str(file_path)] = memory.file_peak
+        for rule, peak in memory.rule_peaks.items():
+            self.rule_peak_memory[rule] = max(self.rule_peak_memory.get(rule, 0), peak)
+
+    # How many times faster each rule ran than its reference implementation
+    def shadow_speedups(self) -> dict[str, float]:
+        return {
+            rule: reference_seconds / max(seconds, 1e-9)
+            for rule, (seconds, reference_seconds) in self.shadow_rule_seconds.items()
+        }
+
+
+def _add_rule_seconds(
+    totals: dict[str, list[float]], rule_seconds: dict[str, list[float]]
+):
+    for rule, seconds in rule_seconds.items():
+        rule_totals = totals.setdefault(rule, [0.0] * len(seconds))
+        for index, value in enumerate(seconds):
+            rule_totals[index] += value
+
+
+def write_report(report: RunReport, report_path: Path):
+    with Path(report_path).open(mode="w", encoding="UTF-8") as report_file:
+        json.dump(asdict(report), report_file, indent=2)
+
+
+def read_report(report_path: Path) -> RunReport:
+    with Path(report_path).open(encoding="UTF-8") as report_file:
+        return RunReport(**json.load(report_file))
+
+
+# Every regular file below root, in a stable order
+def discover_files(root: Path) -> list[Path]:
+    root = Path(root)
+    if root.is_file():
+        return [root]
+    elif not root.exists():
+        raise FileNotFoundError()
+
+    found = []
+    for directory, subdirectories, file_names in os.walk(root):
+        subdirectories.sort()
+        for file_name in sorted(file_names):
+            nested_file = Path(directory) / file_name
+            if nested_file.is_file():
+                found.append(nested_file)
+    return found
+
+
+# The files below root that belong to one of shard_count shards.
+#
+# Shards are chosen from a hash of each file's path relative to root, so every
+# runner checking out the same tree agrees on the split without coordinating.
+# With balance_by_size, files are dealt largest first to the lightest shard,
+# which evens out the work when a few files dominate the tree.
+def shard_files(
+    root: Path,
+    files: list[Path],
+    shard_index: int,
+    shard_count: int,
+    balance_by_size: bool = False,
+) -> list[Path]:
+    """
+    >>> files = [Path(f"src/File{number}.java") for number in range(6)]
+    >>> shards = [shard_files(Path("src"), files, index, 3) for index in (1, 2, 3)]
+    >>> sorted(sum(shards, [])) == sorted(files)
+    True
+    """
+    keys = {file: _shard_key(root, file) for file in files}
+    if not balance_by_size:
+        return [file for file in files if keys[file] % shard_count == shard_index - 1]
+
+    sizes = {file: file.stat().st_size for file in files}
+    shard_sizes = [0] * shard_count
+    selected = set()
+    for file in sorted(files, key=lambda file: (-sizes[file], keys[file])):
+        lightest = shard_sizes.index(min(shard_sizes))
+        shard_sizes[lightest] += sizes[file]
+        if lightest == shard_index - 1:
+            selected.add(file)
+    return [file for file in files if file in selected]
+
+
+def _read_quarantine(quarantine: Path) -> set[str]:
+    if not quarantine.exists():
+        return set()
+    with quarantine.open(encoding="UTF-8") as quarantine_file:
+        return {line.rstrip("\n") for line in quarantine_file if line.strip()}
+
+
+def _add_to_quarantine(quarantine: Path, file_path: Path):
+    with quarantine.open(mode="a", encoding="UTF-8") as quarantine_file:
+        quarantine_file.write(f"{file_path.resolve()}\n")
+
+
+def _shard_key(root: Path, file: Path) -> int:
+    relative_path = file.relative_to(root).as_posix() if file != root else file.name
+    return int.from_bytes(hashlib.sha1(relative_path.encode("UTF-8")).digest()[:8])
+
+
+# The files below root that this run should reformat, in discovery order.
+# Files without any rules are never opened, and files skipped because they are
+# quarantined are recorded on the report.
+def select_files(root: Path, options: PipelineOptions, report: RunReport) -> list[Path]:
+    files = [
+        file
+        for file in discover_files(root)
+        if file_rules(file.name, options.full_mode)
+    ]
+    if options.shard is not None:
+        shard_index, shard_count = options.shard
+        files = shard_files(
+            Path(root), files, shard_index, shard_count, options.balance_shards
+        )
+    if options.quarantine is not None:
+        quarantined = _read_quarantine(options.quarantine)
+        if quarantined:
+            kept = []
+            for file in files:
+                if str(file.resolve()) in quarantined:
+                    report.quarantined_files.append(str(file))
+                else:
+                    kept.append(file)
+            files = kept
+    return files
+
+
+# Reformat every file below root, overlapping file I/O with the rules.
+#
+# I/O threads read up to prefetch_depth files ahead of the rules, which run on
+# the calling thread in discovery order. Changed files are handed to a
+# writeback pool holding at most writeback_depth files, so at most
+# prefetch_depth + writeback_depth + 1 file contents are held at once. With
+# max_memory, files are also only read while their estimated memory fits.
+def reformat_tree(root: Path, options: PipelineOptions | None = None) -> RunReport:
+    options = options or PipelineOptions()
+    report = RunReport()
+    started = time.perf_counter()
+    budget = _MemoryBudget(options.max_memory)
+
+    files = select_files(root, options, report)
+    prefetched: deque[tuple[Path, int, Future[tuple[str, str, str] | None]]] = deque()
+    pending_writes: set[Future[None]] = set()
+
+    started_tracing = options.trace_memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    try:
+        with _open_journal(options) as journal, ThreadPoolExecutor(
+            options.read_workers, thread_name_prefix="reformat-read"
+        ) as readers, ThreadPoolExecutor(
+            options.write_workers, thread_name_prefix="reformat-write"
+        ) as writers:
+            remaining = _sized_files(files, budget, readers, options.prefetch_depth)
+            next_file = next(remaining, None)
+            while next_file or prefetched:
+                while next_file and len(prefetched) < options.prefetch_depth:
+                    next_path, footprint = next_file
+                    if not budget.try_acquire(footprint):
+                        if prefetched:
+                            # Reformat what is already read to free memory first
+                            break
+                        # Only writes in flight hold memory; wait for them
+                        budget.acquire(footprint)
+                    pending_read = readers.submit(
+                        _prefetch_file, next_path, options, journal
+                    )
+                    prefetched.append((next_path, footprint, pending_read))
+                    next_file = next(remaining, None)
+
+                file_path, footprint, pending_read = prefetched.popleft()
+                to_write = _reformat_prefetched(
+                    file_path, pending_read, options, journal, report
+                )
+                if to_write is None:
+                    budget.release(footprint)
+                    continue
+
+                while len(pending_writes) >= options.writeback_depth:
+                    done, pending_writes = wait(
+                        pending_writes, return_when=FIRST_COMPLETED
+                    )
+                    for write in done:
+                        write.result()
+                write = writers.submit(_write_back, file_path, *to_write, journal)
+                write.add_done_callback(
+                    lambda _, footprint=footprint: budget.release(footprint)
+                )
+                pending_writes.add(write)
+
+            for write in pending_writes:
+                write.result()
+    finally:
+        if started_tracing:
+            tracemalloc.stop()
+
+    report.elapsed_seconds = time.perf_counter() - started
+    return report
+
+
+# Each file with its estimated footprint for the memory budget. The sizes are
+# read up to `lookahead` files ahead on the read threads, so the rules' thread
+# never waits on file metadata, and each file is only looked at once.
+def _sized_files(
+    files: list[Path], budget: "_MemoryBudget", readers: Executor, lookahead: int
+) -> Iterator[tuple[Path, int]]:
+    if budget.limit is None:
+        yield from ((file, 0) for file in files)
+        return
+    sizing: deque[tuple[Path, Future[int]]] = deque()
+    for file in files:
+        sizing.append((file, readers.submit(budget.footprint, file)))
+        if len(sizing) > lookahead:
+            sized_file, footprint = sizing.popleft()
+            yield sized_file, footprint.result()
+    for sized_file, footprint in sizing:
+        yield sized_file, footprint.result()
+
+
+# The CPU stage of reformat_tree: run the rules on one prefetched file and
+# record the outcome on the report. Returns the new contents, encoding and
+# input hash if the file needs writing back.
+def _reformat_prefetched(
+    file_path: Path,
+    pending_read: Future[tuple[str, str, str] | None],
+    options: PipelineOptions,
+    journal: Journal | None,
+    report: RunReport,
+) -> tuple[str, str, str] | None:
+    try:
+        prefetched_file = pending_read.result()
+    except SkippedFileError as skipped:
+        report.skipped_files.append({"file": str(file_path), "reason": skipped.reason})
+        return None
+    if prefetched_file is None:
+        report.files_resumed += 1
+        return None
+    file_data, encoding, input_hash = prefetched_file
+
+    shadow = None
+    if _in_shadow_sample(file_path, options.shadow_rate):
+        shadow = ShadowResult(options.shadow_reference_cap)
+    memory = MemoryPeaks() if options.trace_memory else None
+    try:
+        new_data = reformat_text(
+            file_path.name,
+            file_data,
+            options.full_mode,
+            options.time_budget,
+            shadow,
+            memory,
+        )
+    except RuleTimeoutError as timeout:
+        report.timed_out.append({"file": str(file_path), "rule": timeout.rule_name})
+        if options.quarantine is not None:
+            _add_to_quarantine(options.quarantine, file_path)
+        return None
+    report.files_processed += 1
+    if shadow is not None:
+        report.add_shadow(file_path, shadow)
+    if memory is not None:
+        report.add_memory(file_path, memory)
+    if new_data == file_data:
+        if journal is not None:
+            journal.record(file_path, input_hash, input_hash)
+        return None
+
+    report.files_changed += 1
+    report.changed_files.append(str(file_path))
+    return new_data, encoding, input_hash
+
+
+# Estimated bytes held per byte of file while it is in the pipeline: the raw
+# bytes, the decoded text, and about four copies' worth while the rules run.
+_FOOTPRINT_PER_BYTE = 6
+
+
+# Admission control for reformat_tree's max_memory. Each file holds its
+# estimated footprint from the time it is read until it is reformatted or
+# written back. A file is admitted while the total fits the limit, or on its
+# own when nothing else is held, so a file larger than the limit runs alone.
+class _MemoryBudget:
+    """
+    >>> budget = _MemoryBudget(100)
+    >>> budget.try_acquire(500), budget.try_acquire(1)
+    (True, False)
+    >>> budget.release(500)
+    >>> budget.try_acquire(60), budget.try_acquire(40), budget.try_acquire(1)
+    (True, True, False)
+    """
+
+    def __init__(self, limit: int | None) -> None:
+        self.limit = limit
+        self._in_use = 0
+        self._condition = threading.Condition()
+
+    def footprint(self, file_path: Path) -> int:
+        if self.limit is None:
+            return 0
+        try:
+            return file_path.stat().st_size * _FOOTPRINT_PER_BYTE
+        except OSError:
+            # The read stage reports the file
+            return 0
+
+    def _fits(self, footprint: int) -> bool:
+        if self.limit is None or self._in_use == 0:
+            return True
+        return self._in_use + footprint <= self.limit
+
+    def try_acquire(self, footprint: int) -> bool:
+        with self._condition:
+            if not self._fits(footprint):
+                return False
+            self._in_use += footprint
+            return True
+
+    def acquire(self, footprint: int):
+        with self._condition:
+            self._condition.wait_for(lambda: self._fits(footprint))
+            self._in_use += footprint
+
+    def release(self, footprint: int):
+        with self._condition:
+            self._in_use -= footprint
+            self._condition.notify_all()
+
+
+def _open_journal(options: PipelineOptions) -> Journal | nullcontext[None]:
+    if options.journal is None:
+        return nullcontext()
+    return Journal(options.journal, options.resume)
+
+
 def _replace_all(
     file_to_modify, replacement_function: Callable[[str], (str, str)]
 ) -> str:
     remaining = file_to_modify
-    modified_file: str = ""
+    modified_file: list[str] = []
     while len(remaining) > 0:
+        _check_time_budget()
         changed, remaining = replacement_function(remaining)
-        modified_file += changed
-    return modified_file
+        modified_file.append(changed)
+    return "".join(modified_file)
 
 
 # Replace old ui-g style classes
@@ -146,7 +1295,29 @@ def shorthand_close_xhtml_elements(old_file: str):
     '<test><newElement class="test" /></test>'
     """
 
-    return _replace_all(old_file, _shorthand_close_xhtml_element)
+    # Each element is tokenized once as the file is walked, so the cost stays
+    # linear in the file size instead of re-tokenizing after every pair.
+    modified_file: list[str] = []
+    copied_up_to = position = 0
+    previous_element = None
+    while True:
+        _check_time_budget()
+        elem_end_index = old_file.find(">", position)
+        if elem_end_index == -1:
+            break
+        element = HtmlElement(old_file[position : elem_end_index + 1])
+        if previous_element is not None and previous_element.pairs_with(element):
+            pair = previous_element.full + element.full
+            pair_index = old_file.find(pair, copied_up_to, elem_end_index + 1)
+            modified_file.append(old_file[copied_up_to:pair_index])
+            modified_file.append(previous_element.close())
+            copied_up_to = position = pair_index + len(pair)
+            previous_element = None
+        else:
+            previous_element = element
+            position = elem_end_index + 1
+    modified_file.append(old_file[copied_up_to:])
+    return "".join(modified_file)
 
 
 def _replace_ui_g_element(old_file: str):
@@ -172,20 +1343,6 @@ def _replace_ui_num_element(old_file: str):
         return f"{first_part}p-", last_part
 
 
-def _shorthand_close_xhtml_element(old_file: str):
-    elements = html_elements(old_file)
-    for index, element in enumerate(elements):
-        if index + 1 == len(elements):
-            break
-        next_element = elements[index + 1]
-        if element.pairs_with(next_element):
-            first_part, _, last_part = old_file.partition(
-                element.full + next_element.full
-            )
-            return f"{first_part}{element.close()}", last_part
-    return old_file, ""
-
-
 def html_elements(old_file: str) -> list[HtmlElement]:
     """
     >>> htmlElements = html_elements("<first></second><third>")
@@ -197,39 +1354,222 @@ def html_elements(old_file: str) -> list[HtmlElement]:
     '<third>'
     """
     elements = []
-    while len(old_file) > 0:
-        elem_end_index = old_file.find(">")
+    position = 0
+    while True:
+        elem_end_index = old_file.find(">", position)
         if elem_end_index == -1:
             return elements
-        next_element_str = old_file[: elem_end_index + 1]
-        # next_element_str = next_element_str.strip("\t\n\r ")
-        elements.append(HtmlElement(next_element_str))
-        old_file = old_file[elem_end_index + 1 :]
-    return elements
+        elements.append(HtmlElement(old_file[position : elem_end_index + 1]))
+        position = elem_end_index + 1
+
+
+# A package or import statement; group 2 is the imported name, unset for package
+_JAVA_STATEMENT = re.compile(
+    r"(?:import\s+(static\s+)?([\w.]+(?:\.\*)?)|package\s+[\w.]+)\s*;[ \t]*"
+)
+
+
+# The package and import lines at the top of a Java file, parsed once.
+#
+# Rules request imports with add() and remove() instead of rewriting import
+# lines themselves, and header() emits the edited section once at the end.
+# A removed import's statement is reused for the first addition, other
+# additions go after the last import, and an unedited header is returned exactly
+# as read. Statements are edited in place, so a line is only dropped when it
+# held nothing but removed imports.
+class JavaImports:
+    r"""
+    >>> imports, body = JavaImports.split("package a;\n\nimport b.C;\n\nclass D {}")
+    >>> imports.remove("b.C")
+    >>> imports.add("java.util.Objects")
+    >>> imports.add("java.math.RoundingMode")
+    >>> print(imports.header() + body)
+    package a;
+    <BLANKLINE>
+    import java.util.Objects;
+    import java.math.RoundingMode;
+    <BLANKLINE>
+    class D {}
+    """
+
+    # mid_line: the header ends where code starts on its last line
+    def __init__(self, header: str = "", mid_line: bool = False) -> None:
+        self._lines = header.splitlines(keepends=True)
+        self._statements = [_java_statements(line)[0] for line in self._lines]
+        self._present = {
+            name
+            for statements in self._statements
+            for name, _, _ in statements
+            if name is not None
+        }
+        self._mid_line = mid_line
+        self._removed: set[str] = set()
+        self._added: list[str] = []
+
+    # Split a Java file into its imports and the rest of the file.
+    #
+    # The header ends at the first line holding anything besides package and
+    # import statements and comments; statements in front of code on that line
+    # still belong to it, the code does not.
+    @classmethod
+    def split(cls, java_file: str) -> tuple[Self, str]:
+        r"""
+        >>> JavaImports.split("import a.B; class C {}\n")[1]
+        'class C {}\n'
+        """
+        header_end = position = 0
+        in_comment = False
+        while position < len(java_file):
+            line_end = java_file.find("\n", position) + 1 or len(java_file)
+            line = java_file[position:line_end]
+            stripped = line.strip()
+            if in_comment or stripped.startswith("/*"):
+                in_comment = "*/" not in stripped
+                position = line_end
+                continue
+            statements, statements_end = _java_statements(line)
+            rest = line[statements_end:].strip()
+            if statements and rest and not rest.startswith("//"):
+                header_end = position + statements_end
+                return cls(java_file[:header_end], True), java_file[header_end:]
+            elif statements:
+                header_end = line_end
+            elif stripped and not stripped.startswith("//"):
+                break
+            position = line_end
+        return cls(java_file[:header_end]), java_file[header_end:]
+
+    # Run rules on the body of a Java file and re-emit its imports once
+    @classmethod
+    def apply(cls, java_file: str, *rules: Callable[[str, Self], str]) -> str:
+        imports, body = cls.split(java_file)
+        for rule in rules:
+            body = rule(body, imports)
+        return imports.header() + body
+
+    def __contains__(self, name: str) -> bool:
+        present = name in self._present and name not in self._removed
+        return present or name in self._added
+
+    def add(self, name: str):
+        if name in self:
+            return
+        elif name in self._removed:
+            self._removed.discard(name)
+        else:
+            self._added.append(name)
+
+    def remove(self, name: str):
+        if name in self._added:
+            self._added.remove(name)
+        elif name in self._present:
+            self._removed.add(name)
+
+    def header(self) -> str:
+        if not self._removed and not self._added:
+            return "".join(self._lines)
+
+        to_add = list(self._added)
+        emitted: set[str] = set()
+        lines: list[str] = []
+        after_imports = None
+        newline = "\n"
+        for line, statements in zip(self._lines, self._statements):
+            pieces: list[str] = []
+            position = 0
+            edited = has_import = False
+            for name, start, end in statements:
+                if name is None:
+                    if after_imports is None:
+                        after_imports = len(lines) + 1
+                    continue
+                if name in self._removed or name in emitted:
+                    edited = True
+                    before = line[position:start]
+                    position = end
+                    if name in self._removed and to_add:
+                        name = to_add.pop(0)
+                        pieces += [before, f"import {name};"]
+                    else:
+                        # Drop the statement and the blanks separating it
+                        if "".join(pieces).strip() or before.strip():
+                            before = before.rstrip(" \t")
+                        else:
+                            after = line[end:]
+                            position += len(after) - len(after.lstrip(" \t"))
+                        pieces.append(before)
+                        continue
+                emitted.add(name)
+                has_import = True
+            pieces.append(line[position:])
+            line = "".join(pieces)
+            if edited and not line.strip():
+                continue
+
+            lines.append(line)
+            if has_import:
+                newline = line[len(line.rstrip("\r\n")) :] or newline
+                after_imports = len(lines)
+
+        if to_add and after_imports is not None:
+            last_line = lines[after_imports - 1]
+            if self._mid_line and after_imports == len(lines):
+                # Code follows on the same line, so the new imports join it
+                new_imports = "".join(f"import {name}; " for name in to_add)
+                if last_line.endswith((" ", "\t")):
+                    lines[-1] = last_line + new_imports
+                else:
+                    lines[-1] = f"{last_line} {new_imports.rstrip()}"
+                return "".join(lines)
+            if not last_line.endswith("\n"):
+                lines[after_imports - 1] += newline
+            new_lines = [f"import {name};{newline}" for name in to_add]
+            if not emitted:
+                # Only a package line so far; separate it from the new imports
+                new_lines.insert(0, newline)
+            lines[after_imports:after_imports] = new_lines
+        return "".join(lines)
+
+
+# The package and import statements a header line starts with, as (imported
+# name or None for the package, start, end), and where those statements end
+def _java_statements(line: str) -> tuple[list[tuple[str | None, int, int]], int]:
+    r"""
+    >>> _java_statements("package a; import static b.C.D; class E {}")
+    ([(None, 0, 10), ('static b.C.D', 11, 31)], 32)
+    """
+    statements: list[tuple[str | None, int, int]] = []
+    position = len(line) - len(line.lstrip(" \t"))
+    while statement_match := _JAVA_STATEMENT.match(line, position):
+        static, name = statement_match.group(1, 2)
+        if name is not None and static:
+            name = f"static {name}"
+        end = line.rindex(";", position, statement_match.end()) + 1
+        statements.append((name, statement_match.start(), end))
+        position = statement_match.end()
+    return statements, position
 
 
 # Replace ObjectUtils with Objects
-def resolve_object_util_deprecation(old_file: str):
+def resolve_object_util_deprecation(
+    old_file: str, imports: JavaImports | None = None
+) -> str:
     """
     >>> resolve_object_util_deprecation('test.add("First " + ObjectUtils.equals(first, second));')
     'test.add("First " + Objects.equals(first, second));'
     """
+    if imports is None:
+        return JavaImports.apply(old_file, resolve_object_util_deprecation)
+
     result = _replace_all(old_file, _replace_inline_object_util_to_string_call)
     result = _replace_all(result, _replace_object_util_to_string_call)
     result = _replace_all(result, _replace_object_util_equals_call)
-    result = _replace_all(result, _replace_object_util_import)
+    if "org.apache.commons.lang3.ObjectUtils" in imports or result != old_file:
+        imports.remove("org.apache.commons.lang3.ObjectUtils")
+        imports.add("java.util.Objects")
     return result
 
 
-def _replace_object_util_import(old_file: str):
-    first_part, _, last_part = old_file.partition(
-        "org.apache.commons.lang3.ObjectUtils"
-    )
-    if last_part == "":
-        return first_part, ""
-    return f"{first_part}java.util.Objects", last_part
-
-
 def _replace_object_util_equals_call(old_file: str):
     first_part, _, last_part = old_file.partition("ObjectUtils.equals")
     if last_part == "":
@@ -332,13 +1672,15 @@ def _replace_raw_event_types_with_generics(old_file: str):
 
     raw_event_options_regex = _get_regex_options_from_list(RAW_EVENT_TYPES)
 
-    explicit_cast_finder = re.compile(r"\((\w*?)\) ?(\w*?).getObject\(\)")
+    # Possessive quantifiers: a word can never also match the ")" or "(" after
+    # it, so backtracking into it is wasted work on long runs of candidates.
+    explicit_cast_finder = re.compile(r"\((\w*+)\) ?(\w*?).getObject\(\)")
     explicit_cast_match = explicit_cast_finder.search(old_file)
     if explicit_cast_match is not None:
         inner_type, event_var_name = explicit_cast_match.group(1, 2)
 
         method_heading_finder = re.compile(
-            rf"(public|private|protected) void (\w*?)\(({raw_event_options_regex}) {event_var_name}\)(\s*?)\u007b"
+            rf"(public|private|protected) void (\w*+)\(({raw_event_options_regex}) {event_var_name}\)(\s*+)\u007b"
         )
 
         event_match = method_heading_finder.search(old_file)
@@ -404,7 +1746,8 @@ JAVA_PRIMITIVE_WRAPPERS = ["Short", "Long", "Boolean", "Integer"]
 
 def _replace_primitive_constructor(old_file: str):
     for primitive in JAVA_PRIMITIVE_WRAPPERS:
-        primitive_finder = re.compile(rf"new {primitive}\((.*?)\)")
+        # Up to the first ")" on the line, without backtracking on a miss
+        primitive_finder = re.compile(rf"new {primitive}\(([^)\n]*+)\)")
         primitive_match = primitive_finder.search(old_file)
         if primitive_match is not None:
             constructor_parameter = primitive_match.group(1)
@@ -415,7 +1758,12 @@ def _replace_primitive_constructor(old_file: str):
     return old_file, ""
 
 
-def resolve_bigdecimal_constants(old_file: str):
+def resolve_bigdecimal_constants(
+    old_file: str, imports: JavaImports | None = None
+) -> str:
+    if imports is None:
+        return JavaImports.apply(old_file, resolve_bigdecimal_constants)
+
     BIG_DECIMAL_ROUNDING_MODES = [
         "ROUND_HALF_EVEN",
         "ROUND_UP",
@@ -428,9 +1776,131 @@ def resolve_bigdecimal_constants(old_file: str):
         if bigdecimal_match is not None:
             rounding_mode = bigdecimal_match.group(1)
             old_file = bigdecimal_finder.sub(f"RoundingMode.{rounding_mode}", old_file)
+            imports.add("java.math.RoundingMode")
 
     return old_file
 
 
+# Java rules that take the file's JavaImports as a second argument
+IMPORT_AWARE_RULES = {resolve_object_util_deprecation, resolve_bigdecimal_constants}
+
+
+# Deprecated usages counted by --audit, as (file suffix, prefilter, pattern).
+# The patterns run on raw bytes, and only once the literal prefilter is found,
+# so most files are dismissed by a single substring search.
+AUDIT_PATTERNS = {
+    "ObjectUtils.toString": (
+        ".java",
+        b"ObjectUtils.toString",
+        re.compile(rb"ObjectUtils\.toString\("),
+    ),
+    "ObjectUtils.equals": (
+        ".java",
+        b"ObjectUtils.equals",
+        re.compile(rb"ObjectUtils\.equals\("),
+    ),
+    "raw wildcard event": (
+        ".java",
+        b"Event",
+        re.compile(
+            rb"(?:private |public |\()(?:%s)(?!<\?>)"
+            % _get_regex_options_from_list(WILDCARD_EVENT_TYPES).encode()
+        ),
+    ),
+    "raw object event": (
+        ".java",
+        b"Event",
+        re.compile(
+            rb"\((?:%s) \w++\)"
+            % _get_regex_options_from_list(RAW_EVENT_TYPES).encode()
+        ),
+    ),
+    "primitive constructor": (
+        ".java",
+        b"new ",
+        re.compile(
+            rb"new (?:%s)\("
+            % _get_regex_options_from_list(JAVA_PRIMITIVE_WRAPPERS).encode()
+        ),
+    ),
+    "BigDecimal.ROUND_*": (
+        ".java",
+        b"BigDecimal.ROUND_",
+        re.compile(rb"BigDecimal\.ROUND_[A-Z_]++"),
+    ),
+    "ui-g": (".xhtml", b"ui-g", re.compile(rb"ui-g")),
+    "ui-sm/md/lg/xl": (".xhtml", b"ui-", re.compile(rb"ui-(?:sm|md|lg|xl)")),
+}
+
+
+# Count the deprecated usages left below root, grouped by directory.
+#
+# Only scans: files are read as bytes on worker threads and nothing is decoded,
+# rewritten or written back.
+def audit_tree(
+    root: Path, depth: int = 1, workers: int = 4
+) -> dict[str, Counter[str]]:
+    root = Path(root)
+    audited_files = [
+        file
+        for file in discover_files(root)
+        if file.name.endswith((".java", ".xhtml"))
+    ]
+
+    counts: dict[str, Counter[str]] = defaultdict(Counter)
+    with ThreadPoolExecutor(workers, thread_name_prefix="reformat-audit") as scanners:
+        for file, file_counts in zip(
+            audited_files, scanners.map(audit_file, audited_files)
+        ):
+            counts[_audit_group(root, file, depth)].update(file_counts)
+    return dict(sorted(counts.items()))
+
+
+def audit_file(file_path: Path) -> Counter[str]:
+    file_data = Path(file_path).read_bytes()
+    file_counts: Counter[str] = Counter()
+    for rule, (suffix, prefilter, pattern) in AUDIT_PATTERNS.items():
+        if file_path.name.endswith(suffix) and prefilter in file_data:
+            file_counts[rule] += sum(1 for _ in pattern.finditer(file_data))
+    return file_counts
+
+
+def _audit_group(root: Path, file: Path, depth: int) -> str:
+    if file == root:
+        return "."
+    directories = file.relative_to(root).parent.parts[:depth]
+    return "/".join(directories) or "."
+
+
+def audit_json(counts: dict[str, Counter[str]]) -> dict:
+    totals: Counter[str] = Counter()
+    for directory_counts in counts.values():
+        totals.update(directory_counts)
+    return {
+        "directories": {
+            directory: {rule: directory_counts[rule] for rule in AUDIT_PATTERNS}
+            for directory, directory_counts in counts.items()
+        },
+        "totals": {rule: totals[rule] for rule in AUDIT_PATTERNS},
+    }
+
+
+def audit_table(counts: dict[str, Counter[str]]) -> str:
+    audit = audit_json(counts)
+    rows = [["directory", *AUDIT_PATTERNS]]
+    for directory, directory_counts in audit["directories"].items():
+        rows.append([directory, *map(str, directory_counts.values())])
+    rows.append(["total", *map(str, audit["totals"].values())])
+
+    widths = [max(len(row[column]) for row in rows) for column in range(len(rows[0]))]
+    return "\n".join(
+        "  ".join(
+            cell.ljust(width) if column == 0 else cell.rjust(width)
+            for column, (cell, width) in enumerate(zip(row, widths))
+        ).rstrip()
+        for row in rows
+    )
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,145 @@
+from reformat_async import (
+    iter_reformat_tree,
+    reformat_text,
+    reformat_tree,
+)
+from reformat_file import PipelineOptions
+import reformat_file
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import aclosing
+from pathlib import Path
+import asyncio
+import json
+import threading
+import time
+
+import pytest
+
+OBJECT_UTIL = 'test.add("First " + ObjectUtils.toString(first.method()));'
+OBJECT_UTIL_EXPECTED = 'test.add("First " + Objects.toString(first.method(), ""));'
+
+
+def _write_tree(directory: Path, file_count: int) -> list[Path]:
+    files = []
+    for number in range(file_count):
+        file = directory / f"File{number}.java"
+        file.write_text(OBJECT_UTIL, encoding="UTF-8")
+        files.append(file)
+    return files
+
+
+def test_reformat_text_in_process_pool():
+    async def run():
+        with ProcessPoolExecutor(1) as executor:
+            return await reformat_text("test.java", OBJECT_UTIL, executor=executor)
+
+    assert asyncio.run(run()) == OBJECT_UTIL_EXPECTED
+
+
+def test_reformat_tree_reports_every_file(tmp_path):
+    files = _write_tree(tmp_path, 10)
+    (tmp_path / "notes.txt").write_text(OBJECT_UTIL, encoding="UTF-8")
+
+    report = asyncio.run(reformat_tree(tmp_path, concurrency=3))
+
+    assert (report.files_processed, report.files_changed) == (10, 10)
+    assert sorted(report.changed_files) == sorted(str(file) for file in files)
+    for file in files:
+        assert file.read_text(encoding="UTF-8") == OBJECT_UTIL_EXPECTED
+
+
+def test_iter_reformat_tree_streams_results_and_stops_when_closed(tmp_path):
+    files = _write_tree(tmp_path, 5)
+
+    async def first_result():
+        async with aclosing(iter_reformat_tree(tmp_path, concurrency=1)) as results:
+            async for result in results:
+                return result
+
+    result = asyncio.run(first_result())
+
+    assert result.changed
+    unchanged = [
+        file for file in files if file.read_text(encoding="UTF-8") == OBJECT_UTIL
+    ]
+    assert len(unchanged) == 4
+
+
+def test_reformat_tree_time_budget(tmp_path):
+    _write_tree(tmp_path, 2)
+
+    report = asyncio.run(reformat_tree(tmp_path, PipelineOptions(time_budget=0)))
+
+    assert report.files_processed == 0
+    assert {timeout["rule"] for timeout in report.timed_out} == {
+        "resolve_object_util_deprecation"
+    }
+
+
+def test_reformat_tree_shadow_mode(tmp_path):
+    _write_tree(tmp_path, 3)
+
+    report = asyncio.run(reformat_tree(tmp_path, PipelineOptions(shadow_rate=1)))
+
+    assert report.shadow_files == 3
+    assert report.shadow_mismatches == []
+
+
+def test_reformat_tree_resumes_from_journal(tmp_path):
+    tree = tmp_path / "tree"
+    tree.mkdir()
+    _write_tree(tree, 3)
+    journal = tmp_path / "journal.jsonl"
+
+    asyncio.run(reformat_tree(tree, PipelineOptions(journal=journal)))
+    report = asyncio.run(
+        reformat_tree(tree, PipelineOptions(journal=journal, resume=True))
+    )
+
+    assert (report.files_resumed, report.files_processed) == (3, 0)
+
+
+def test_reformat_tree_max_memory(tmp_path):
+    files = _write_tree(tmp_path, 4)
+
+    report = asyncio.run(reformat_tree(tmp_path, PipelineOptions(max_memory=1)))
+
+    assert report.files_changed == 4
+    for file in files:
+        assert file.read_text(encoding="UTF-8") == OBJECT_UTIL_EXPECTED
+
+
+def test_reformat_tree_rejects_concurrency_below_one(tmp_path):
+    _write_tree(tmp_path, 1)
+
+    with pytest.raises(ValueError, match="concurrency"):
+        asyncio.run(reformat_tree(tmp_path, concurrency=0))
+
+
+def test_cancelled_run_waits_for_writes_before_closing_journal(tmp_path, monkeypatch):
+    tree = tmp_path / "tree"
+    tree.mkdir()
+    [file] = _write_tree(tree, 1)
+    journal = tmp_path / "journal.jsonl"
+    write_started = threading.Event()
+    write_back = reformat_file._write_back
+
+    def slow_write_back(*args):
+        write_started.set()
+        time.sleep(0.2)
+        write_back(*args)
+
+    monkeypatch.setattr(reformat_file, "_write_back", slow_write_back)
+
+    async def cancel_during_write():
+        run = asyncio.create_task(reformat_tree(tree, PipelineOptions(journal=journal)))
+        await asyncio.to_thread(write_started.wait)
+        run.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await run
+
+    asyncio.run(cancel_during_write())
+
+    assert file.read_text(encoding="UTF-8") == OBJECT_UTIL_EXPECTED
+    entries = [json.loads(line) for line in journal.read_text().splitlines()]
+    assert [entry["file"] for entry in entries] == [str(file.resolve())]
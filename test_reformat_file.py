@@ -2,14 +2,29 @@ from reformat_file import (
     resolve_bigdecimal_constants,
     resolve_object_util_deprecation,
     reformat_file,
+    reformat_tree,
+    PipelineOptions,
+    RunReport,
+    RuleTimeoutError,
+    reformat_text,
+    shadow_reformat_text,
+    audit_json,
+    audit_table,
+    audit_tree,
+    main,
+    read_report,
+    shard_files,
     resolve_primitive_constructors,
     resolve_raw_events,
     resolve_raw_tabchange,
     ui_g_to_p_grid,
     html_elements,
     shorthand_close_xhtml_elements,
+    _MemoryBudget,
 )
 from pathlib import Path
+import inspect
+import threading
 import pytest
 
 OBJECT_UTIL_REPEATED = """
@@ -136,8 +151,8 @@ test.add("First " + Objects.toString(exampleVariable.method(), ""));
 
 
 def test_inline_replace():
-    # java.util.Objects will need to be imported manually if it hasn't been already!
-    # TODO: Do this automatically
+    # Snippets without a package or import section don't get java.util.Objects
+    # imported; see test_imports_added_after_package_line
 
     OBJECT_UTIL_INLINE = (
         'test.add("First " + org.apache.commons.lang3.ObjectUtils.toString(object));'
@@ -440,3 +455,454 @@ private BigDecimal total = BigDecimal.ZERO.setScale(2, RoundingMode.ROUND_UP);
 """
 
     assert resolve_bigdecimal_constants(INT_VERSION) == ENUM_VERSION
+
+
+def test_reformat_tree_walks_nested_directories(tmp_path):
+    nested_directory = tmp_path / "module" / "src"
+    nested_directory.mkdir(parents=True)
+    (nested_directory / "first.java").write_text(OBJECT_UTIL_REPEATED, encoding="UTF-8")
+    (tmp_path / "second.java").write_text(OBJECT_UTIL_REPEATED, encoding="UTF-8")
+    (tmp_path / "notes.txt").write_text("ObjectUtils.toString(x)", encoding="UTF-8")
+
+    report = reformat_tree(
+        tmp_path, PipelineOptions(read_workers=2, prefetch_depth=1, writeback_depth=1)
+    )
+
+    assert (report.files_processed, report.files_changed) == (2, 2)
+    assert (nested_directory / "first.java").read_text(
+        encoding="UTF-8"
+    ) == OBJECT_UTIL_REPEATED_EXPECTED
+    assert (tmp_path / "second.java").read_text(
+        encoding="UTF-8"
+    ) == OBJECT_UTIL_REPEATED_EXPECTED
+    assert (tmp_path / "notes.txt").read_text(
+        encoding="UTF-8"
+    ) == "ObjectUtils.toString(x)"
+
+
+def test_reformat_directory_keeps_full_mode(tmp_path):
+    (tmp_path / "nested").mkdir()
+    (tmp_path / "nested" / "test.xhtml").write_text(
+        '<div class="ui-g"></div>', encoding="UTF-8"
+    )
+
+    reformat_file(tmp_path, full_mode=True)
+
+    assert (tmp_path / "nested" / "test.xhtml").read_text(
+        encoding="UTF-8"
+    ) == '<div class="p-grid" />'
+
+
+def test_shards_partition_the_tree(tmp_path):
+    files = []
+    for number in range(20):
+        file = tmp_path / f"File{number}.java"
+        file.write_text("x" * number, encoding="UTF-8")
+        files.append(file)
+
+    for balance_by_size in (False, True):
+        shards = [
+            shard_files(tmp_path, files, index, 3, balance_by_size)
+            for index in (1, 2, 3)
+        ]
+        assert sorted(sum(shards, [])) == sorted(files)
+        assert shards[0] == shard_files(tmp_path, files, 1, 3, balance_by_size)
+
+    balanced_sizes = [
+        sum(file.stat().st_size for file in shard_files(tmp_path, files, index, 3, True))
+        for index in (1, 2, 3)
+    ]
+    assert max(balanced_sizes) - min(balanced_sizes) <= 19
+
+
+def test_sharded_reports_merge(tmp_path):
+    tree = tmp_path / "tree"
+    tree.mkdir()
+    for number in range(6):
+        (tree / f"File{number}.java").write_text(
+            OBJECT_UTIL_REPEATED, encoding="UTF-8"
+        )
+
+    report_paths = []
+    for index in (1, 2):
+        report_path = tmp_path / f"shard{index}.json"
+        main([str(tree), "--shard", f"{index}/2", "--report", str(report_path)])
+        report_paths.append(str(report_path))
+    merged_path = tmp_path / "merged.json"
+    main(["--merge-reports", *report_paths, "--report", str(merged_path)])
+
+    merged = read_report(merged_path)
+    assert merged.files_processed == merged.files_changed == 6
+    assert merged.changed_files == sorted(str(file) for file in tree.iterdir())
+    assert RunReport.merge([]) == RunReport()
+
+
+def test_time_budget_names_the_running_rule():
+    with pytest.raises(RuleTimeoutError) as timeout:
+        reformat_text("test.java", OBJECT_UTIL_REPEATED, time_budget=0)
+
+    assert timeout.value.rule_name == "resolve_object_util_deprecation"
+
+
+def test_files_over_time_budget_are_skipped_and_quarantined(tmp_path):
+    tree = tmp_path / "tree"
+    tree.mkdir()
+    (tree / "test.java").write_text(OBJECT_UTIL_REPEATED, encoding="UTF-8")
+    quarantine = tmp_path / "quarantine.txt"
+
+    report = reformat_tree(tree, PipelineOptions(time_budget=0, quarantine=quarantine))
+
+    assert report.timed_out == [
+        {"file": str(tree / "test.java"), "rule": "resolve_object_util_deprecation"}
+    ]
+    assert (tree / "test.java").read_text(encoding="UTF-8") == OBJECT_UTIL_REPEATED
+
+    report = reformat_tree(tree, PipelineOptions(quarantine=quarantine))
+
+    assert report.quarantined_files == [str(tree / "test.java")]
+    assert report.files_processed == 0
+
+
+def test_shorthand_replacement_of_many_pairs():
+    assert shorthand_close_xhtml_elements("<a></a>\n" * 50000) == "<a />\n" * 50000
+
+
+def test_audit_counts_per_rule_and_directory_without_writing(tmp_path):
+    (tmp_path / "core").mkdir()
+    (tmp_path / "web" / "pages").mkdir(parents=True)
+    java_file = tmp_path / "core" / "Test.java"
+    java_file.write_text(
+        OBJECT_UTIL_REPEATED + "new Long(3);\nBigDecimal.ROUND_HALF_UP;\n",
+        encoding="UTF-8",
+    )
+    (tmp_path / "web" / "pages" / "test.xhtml").write_text(
+        '<div class="ui-g"><div class="ui-g-12 ui-md-6">', encoding="UTF-8"
+    )
+    (tmp_path / "web" / "notes.txt").write_text("ui-g", encoding="UTF-8")
+
+    audit = audit_json(audit_tree(tmp_path))
+
+    assert audit["directories"]["core"]["ObjectUtils.toString"] == 2
+    assert audit["directories"]["core"]["primitive constructor"] == 1
+    assert audit["directories"]["core"]["BigDecimal.ROUND_*"] == 1
+    assert audit["directories"]["web"]["ui-g"] == 2
+    assert audit["directories"]["web"]["ui-sm/md/lg/xl"] == 1
+    assert audit["totals"]["raw wildcard event"] == 0
+    assert list(audit_tree(tmp_path, depth=2)) == ["core", "web/pages"]
+    assert audit_table(audit_tree(tmp_path)).splitlines()[-1].startswith("total")
+    assert java_file.read_text(encoding="UTF-8").startswith(OBJECT_UTIL_REPEATED)
+
+
+def test_object_util_import_is_not_duplicated():
+    OBJECT_UTIL_BOTH_IMPORTS = """package example;
+
+import java.util.Objects;
+import org.apache.commons.lang3.ObjectUtils;
+
+class Example {
+    boolean same = ObjectUtils.equals(first, second);
+}
+"""
+
+    OBJECT_UTIL_BOTH_IMPORTS_EXPECTED = """package example;
+
+import java.util.Objects;
+
+class Example {
+    boolean same = Objects.equals(first, second);
+}
+"""
+
+    assert (
+        reformat_text("Example.java", OBJECT_UTIL_BOTH_IMPORTS)
+        == OBJECT_UTIL_BOTH_IMPORTS_EXPECTED
+    )
+
+
+def test_bigdecimals_add_rounding_mode_import():
+    INT_VERSION = """package example;
+
+import java.math.BigDecimal;
+
+class Example {
+    BigDecimal total = BigDecimal.ZERO.setScale(2, BigDecimal.ROUND_UP);
+}
+"""
+    ENUM_VERSION = """package example;
+
+import java.math.BigDecimal;
+import java.math.RoundingMode;
+
+class Example {
+    BigDecimal total = BigDecimal.ZERO.setScale(2, RoundingMode.ROUND_UP);
+}
+"""
+
+    assert resolve_bigdecimal_constants(INT_VERSION) == ENUM_VERSION
+    assert resolve_bigdecimal_constants(ENUM_VERSION) == ENUM_VERSION
+
+
+def test_imports_added_after_package_line():
+    OBJECT_UTIL_NO_IMPORTS = """package example;
+
+class Example {
+    String name = ObjectUtils.toString(value);
+}
+"""
+
+    OBJECT_UTIL_NO_IMPORTS_EXPECTED = """package example;
+
+import java.util.Objects;
+
+class Example {
+    String name = Objects.toString(value, "");
+}
+"""
+
+    assert (
+        reformat_text("Example.java", OBJECT_UTIL_NO_IMPORTS)
+        == OBJECT_UTIL_NO_IMPORTS_EXPECTED
+    )
+
+
+def test_unreadable_files_are_skipped_without_stopping_the_run(tmp_path):
+    (tmp_path / "Latin.java").write_bytes("// café\nnew Long(1);".encode("latin-1"))
+    (tmp_path / "Binary.java").write_bytes(b"\xca\xfe\xba\xbe\0\0new Long(1);")
+    (tmp_path / "Large.java").write_text("new Long(1);" * 100, encoding="UTF-8")
+    (tmp_path / "Small.java").write_text("new Long(1);", encoding="UTF-8")
+
+    report = reformat_tree(tmp_path, PipelineOptions(max_file_size=1000))
+
+    assert report.changed_files == [str(tmp_path / "Small.java")]
+    assert {skipped["file"] for skipped in report.skipped_files} == {
+        str(tmp_path / name) for name in ("Latin.java", "Binary.java", "Large.java")
+    }
+
+
+def test_reformat_file_has_the_pipeline_size_limit():
+    parameters = inspect.signature(reformat_file).parameters
+
+    assert parameters["max_file_size"].default == PipelineOptions.max_file_size
+
+
+def test_fallback_encoding_is_kept_on_write(tmp_path):
+    latin_file = tmp_path / "Latin.java"
+    latin_file.write_bytes("// café\nnew Long(1);".encode("latin-1"))
+
+    reformat_file(latin_file, fallback_encoding="latin-1")
+
+    assert latin_file.read_bytes() == "// café\nLong.valueOf(1);".encode("latin-1")
+
+
+def test_byte_order_mark_and_line_endings_are_kept(tmp_path):
+    bom_file = tmp_path / "Bom.java"
+    bom_file.write_bytes(b"\xef\xbb\xbfpackage a;\r\n\r\nnew Long(1);\r\n")
+
+    reformat_file(bom_file)
+
+    assert bom_file.read_bytes() == (
+        b"\xef\xbb\xbfpackage a;\r\n\r\nLong.valueOf(1);\r\n"
+    )
+
+
+@pytest.mark.parametrize(
+    "byte_order_mark, codec",
+    [(b"\xff\xfe", "utf-16-le"), (b"\xfe\xff", "utf-16-be")],
+)
+def test_utf16_byte_order_is_kept(tmp_path, byte_order_mark, codec):
+    utf16_file = tmp_path / "Utf16.java"
+    utf16_file.write_bytes(byte_order_mark + "new Long(1);\n".encode(codec))
+
+    reformat_file(utf16_file)
+
+    assert utf16_file.read_bytes() == (
+        byte_order_mark + "Long.valueOf(1);\n".encode(codec)
+    )
+
+
+def test_shadow_mode_matches_the_reference_rules(tmp_path):
+    (tmp_path / "Test.java").write_text(OBJECT_UTIL_REPEATED, encoding="UTF-8")
+    (tmp_path / "test.xhtml").write_text(
+        '<div class="ui-g"><p></p></div>', encoding="UTF-8"
+    )
+
+    report = reformat_tree(tmp_path, PipelineOptions(full_mode=True, shadow_rate=1))
+
+    assert report.shadow_files == 2
+    assert report.shadow_mismatches == []
+    assert set(report.shadow_speedups()) == {
+        "resolve_object_util_deprecation",
+        "resolve_raw_tabchange",
+        "resolve_raw_events",
+        "resolve_primitive_constructors",
+        "resolve_bigdecimal_constants",
+        "ui_g_to_p_grid",
+        "shorthand_close_xhtml_elements",
+    }
+
+
+def test_shadow_mode_minimizes_mismatches():
+    # The reference rule also rewrote fully qualified ObjectUtils outside imports
+    FULLY_QUALIFIED = """class Example {
+    int first = 1;
+    boolean empty = org.apache.commons.lang3.ObjectUtils.isEmpty(value);
+    int second = 2;
+}
+"""
+
+    _, shadow = shadow_reformat_text("Example.java", FULLY_QUALIFIED)
+
+    assert shadow.mismatches == [
+        {
+            "rule": "resolve_object_util_deprecation",
+            "reproducer": "    boolean empty = org.apache.commons.lang3.ObjectUtils.isEmpty(value);\n",
+            "expected": "    boolean empty = java.util.Objects.isEmpty(value);\n",
+            "actual": "    boolean empty = org.apache.commons.lang3.ObjectUtils.isEmpty(value);\n",
+        }
+    ]
+
+
+def test_resume_skips_journaled_files_that_are_unchanged(tmp_path):
+    tree = tmp_path / "tree"
+    tree.mkdir()
+    first_file = tree / "First.java"
+    second_file = tree / "Second.java"
+    first_file.write_text(OBJECT_UTIL_REPEATED, encoding="UTF-8")
+    second_file.write_text("class Second {}", encoding="UTF-8")
+    journal = tmp_path / "journal.jsonl"
+
+    report = reformat_tree(tree, PipelineOptions(journal=journal))
+
+    assert report.files_processed == 2
+    assert len(journal.read_text(encoding="UTF-8").splitlines()) == 2
+
+    second_file.write_text("new Long(1);", encoding="UTF-8")
+    report = reformat_tree(tree, PipelineOptions(journal=journal, resume=True))
+
+    assert report.files_resumed == 1
+    assert report.changed_files == [str(second_file)]
+    assert first_file.read_text(encoding="UTF-8") == OBJECT_UTIL_REPEATED_EXPECTED
+    assert second_file.read_text(encoding="UTF-8") == "Long.valueOf(1);"
+    assert sorted(path.name for path in tree.iterdir()) == ["First.java", "Second.java"]
+
+
+def test_single_file_honours_pipeline_flags(tmp_path):
+    java_file = tmp_path / "A.java"
+    java_file.write_text(OBJECT_UTIL_REPEATED, encoding="UTF-8")
+    journal = tmp_path / "journal.jsonl"
+    report_path = tmp_path / "report.json"
+    quarantine = tmp_path / "quarantine.txt"
+
+    main([str(java_file), "--journal", str(journal), "--report", str(report_path)])
+
+    assert java_file.read_text(encoding="UTF-8") == OBJECT_UTIL_REPEATED_EXPECTED
+    assert len(journal.read_text(encoding="UTF-8").splitlines()) == 1
+    assert read_report(report_path).changed_files == [str(java_file)]
+
+    java_file.write_text(OBJECT_UTIL_REPEATED, encoding="UTF-8")
+    main([str(java_file), "--time-budget", "0", "--quarantine", str(quarantine)])
+
+    assert java_file.read_text(encoding="UTF-8") == OBJECT_UTIL_REPEATED
+    assert quarantine.read_text(encoding="UTF-8") == f"{java_file.resolve()}\n"
+
+
+def test_trace_memory_reports_file_and_rule_peaks(tmp_path):
+    (tmp_path / "Test.java").write_text(OBJECT_UTIL_REPEATED * 50, encoding="UTF-8")
+    (tmp_path / "test.xhtml").write_text("<a></a>\n" * 500, encoding="UTF-8")
+
+    report = reformat_tree(tmp_path, PipelineOptions(trace_memory=True))
+
+    assert set(report.file_peak_memory) == {
+        str(tmp_path / "Test.java"),
+        str(tmp_path / "test.xhtml"),
+    }
+    assert all(peak > 0 for peak in report.file_peak_memory.values())
+    assert report.rule_peak_memory["shorthand_close_xhtml_elements"] > 0
+    assert report.rule_peak_memory["resolve_object_util_deprecation"] > 0
+
+
+def test_max_memory_still_reformats_files_over_the_budget(tmp_path):
+    for number in range(5):
+        (tmp_path / f"File{number}.java").write_text(
+            OBJECT_UTIL_REPEATED, encoding="UTF-8"
+        )
+
+    report = reformat_tree(tmp_path, PipelineOptions(max_memory=1))
+
+    assert report.files_changed == 5
+    for file in tmp_path.iterdir():
+        assert file.read_text(encoding="UTF-8") == OBJECT_UTIL_REPEATED_EXPECTED
+
+
+def test_max_memory_sizes_each_file_once_off_the_rules_thread(tmp_path, monkeypatch):
+    for number in range(5):
+        (tmp_path / f"File{number}.java").write_text(
+            OBJECT_UTIL_REPEATED, encoding="UTF-8"
+        )
+    sized = []
+    footprint = _MemoryBudget.footprint
+
+    def recording_footprint(budget, file_path):
+        sized.append((file_path, threading.current_thread()))
+        return footprint(budget, file_path)
+
+    monkeypatch.setattr(_MemoryBudget, "footprint", recording_footprint)
+    reformat_tree(tmp_path, PipelineOptions(max_memory=1))
+
+    assert sorted(file_path for file_path, _ in sized) == sorted(tmp_path.iterdir())
+    assert threading.main_thread() not in {thread for _, thread in sized}
+
+
+def test_slow_reference_rule_does_not_time_out_the_file(tmp_path):
+    (tmp_path / "test.xhtml").write_text("<a></a>\n" * 8000, encoding="UTF-8")
+    quarantine = tmp_path / "quarantine.txt"
+
+    report = reformat_tree(
+        tmp_path,
+        PipelineOptions(
+            time_budget=0.5,
+            quarantine=quarantine,
+            shadow_rate=1,
+            shadow_reference_cap=0.1,
+        ),
+    )
+
+    assert report.timed_out == []
+    assert not quarantine.exists()
+    assert report.files_changed == 1
+    assert report.shadow_reference_timeouts == [
+        {
+            "file": str(tmp_path / "test.xhtml"),
+            "rule": "shorthand_close_xhtml_elements",
+        }
+    ]
+
+
+@pytest.mark.parametrize("shadow_rate", ["-3", "1.5", "nan"])
+def test_shadow_rate_must_be_a_fraction(shadow_rate):
+    with pytest.raises(SystemExit):
+        main(["./fakefile.txt", "--shadow-rate", shadow_rate])
+
+
+def test_unknown_fallback_encoding_fails_before_reading(tmp_path):
+    with pytest.raises(SystemExit):
+        main([str(tmp_path), "--fallback-encoding", "latn-1"])
+    with pytest.raises(LookupError):
+        PipelineOptions(fallback_encoding="latn-1")
+
+
+def test_single_line_java_file_keeps_its_code():
+    SINGLE_LINE = (
+        "import java.util.List; import org.apache.commons.lang3.ObjectUtils; "
+        "public class A { String x = ObjectUtils.toString(y); }\n"
+    )
+
+    SINGLE_LINE_EXPECTED = (
+        "import java.util.List; import java.util.Objects; "
+        'public class A { String x = Objects.toString(y, ""); }\n'
+    )
+
+    assert reformat_text("A.java", SINGLE_LINE) == SINGLE_LINE_EXPECTED
+    assert reformat_text("A.java", "package a; class A { Long x = new Long(1); }") == (
+        "package a; class A { Long x = Long.valueOf(1); }"
+    )